@@ -1 +1,37 @@
-"""Nozomi package configuration."""
+"""Nozomi package configuration.
+
+Submodules are loaded lazily on first attribute access so that importing the package (or the
+dependency-free ``nozomi.helpers`` module) does not pull in ``requests`` or ``dacite``.
+
+"""
+
+import importlib
+from typing import Any, List
+
+
+_SUBMODULES = ('api', 'data', 'exceptions', 'helpers', 'planner')
+
+
+def __getattr__(name: str) -> Any:
+    """Import a submodule the first time it is accessed as a package attribute.
+
+    Args:
+        name: The name of the attribute being accessed.
+
+    Raises:
+        AttributeError: If the attribute is not a nozomi submodule.
+
+    Returns:
+        The imported submodule.
+
+    """
+    if name in _SUBMODULES:
+        module = importlib.import_module(f'{__name__}.{name}')
+        globals()[name] = module
+        return module
+    raise AttributeError(f"module '{__name__}' has no attribute '{name}'")
+
+
+def __dir__() -> List[str]:
+    """List the package attributes, including the lazily loaded submodules."""
+    return sorted(set(globals()) | set(_SUBMODULES))
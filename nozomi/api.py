@@ -1,21 +1,32 @@
-"""Web API functions."""
+"""Web API functions.
+
+Tag searches rely on the post IDs of every .nozomi file being sorted from newest to oldest
+(descending). Probing a file with ranged requests checks that its first post ID is greater than
+its last, and falls back to reading the whole file otherwise. Streaming a file checks the order of
+every post ID read, and raises InvalidIndexOrder if a post ID read is out of order.
+
+"""
 
 import logging
 import struct
 import shutil
 from pathlib import Path
-from typing import Iterable, List
+from typing import Dict, Iterable, Iterator, List, Optional, Set, Tuple, Union
 
 import requests
 from dacite import from_dict
 
 from nozomi.data import Post
-from nozomi.exceptions import InvalidTagFormat, InvalidUrlFormat
-from nozomi.helpers import sanitize_tag, create_tag_filepath, create_post_filepath, parse_post_id
+from nozomi.exceptions import InvalidIndexOrder, InvalidTagFormat, InvalidUrlFormat
+from nozomi.helpers import create_tag_filepath, create_post_filepath, parse_post_id
+from nozomi.planner import PROBE, PROBE_REQUEST_COST, PlanStep, QueryPlan, TagCatalog, plan_query
 
 
 _LOGGER = logging.getLogger(__name__)
 
+# The default number of bytes of tag indexes read at once by a streamed search.
+STREAM_MEMORY_BUDGET = 1024 * 1024
+
 
 def get_post(url: str) -> Post:
     """Retrieve a single post.
@@ -55,12 +66,32 @@ def get_posts(urls: List[str]) -> Iterable[Post]:
         yield get_post(url)
 
 
-def get_posts_with_tags(positive_tags: List[str], negative_tags: List[str] = None) -> Iterable[Post]:
+def get_posts_with_tags(positive_tags: List[str], negative_tags: List[str] = None,
+                        catalog: TagCatalog = None, stream: bool = False,
+                        memory_budget: int = STREAM_MEMORY_BUDGET,
+                        request_cost: int = PROBE_REQUEST_COST) -> Iterable[Post]:
     """Retrieve all post data that contains and doesn't contain certain tags.
 
+    The tag indexes are fetched in the order decided by the query planner, which uses the tag
+    statistics of the catalog if one is provided. The catalog is updated with the size of every
+    index fetched and with the tags of every retrieved post.
+
+    In streaming mode the tag indexes are read in chunks and filtered as they arrive, so posts are
+    yielded from newest to oldest as soon as they are found and the post IDs are never held in
+    memory all at once.
+
     Args:
         positive_tags: The tags that the posts retrieved must contain.
         negative_tags: Optional, blacklisted tags.
+        catalog: Optional, the tag statistics used to plan the search and updated by it.
+        stream: Optional, whether to stream the tag indexes instead of downloading them in full.
+        memory_budget: Optional, the number of raw bytes of tag indexes read at once when
+            streaming, split evenly between the indexes. A decompressed chunk may be larger.
+        request_cost: Optional, the number of bytes a ranged request is considered to be worth
+            when planning whether to probe an index instead of downloading it.
+
+    Raises:
+        InvalidIndexOrder: If a streamed index is not sorted from newest to oldest.
 
     Yields:
         A post in JSON format, which contains the positive tags and doesn't contain the negative
@@ -72,13 +103,20 @@ def get_posts_with_tags(positive_tags: List[str], negative_tags: List[str] = Non
     _LOGGER.debug('Retrieving posts with positive_tags=%s and negative_tags=%s',
                   str(positive_tags), str(negative_tags))
     try:
-        positive_post_urls = _get_post_urls(positive_tags)
-        negative_post_urls = _get_post_urls(negative_tags)
-        relevant_post_urls = set(positive_post_urls) - set(negative_post_urls)
+        # Without a catalog, the index sizes learned during the search are only kept until it ends.
+        search_catalog = catalog if catalog is not None else TagCatalog()
+        plan = plan_query(positive_tags, negative_tags, search_catalog, request_cost)
+        if stream:
+            relevant_post_urls = _stream_post_urls(plan, search_catalog, memory_budget)
+        else:
+            relevant_post_urls = _get_post_urls(plan, search_catalog)
         for post_url in relevant_post_urls:
             post_data = requests.get(post_url).json()
             _LOGGER.debug(post_data)
-            yield from_dict(data_class=Post, data=post_data)
+            post = from_dict(data_class=Post, data=post_data)
+            if catalog is not None:
+                catalog.record_post(post)
+            yield post
     except InvalidTagFormat:
         raise
     except Exception as ex:
@@ -131,28 +169,175 @@ def _download_media(image_url: str, filepath: Path):
     _LOGGER.debug('Image downloaded %s', filepath)
 
 
-def _get_post_urls(tags: List[str]) -> List[str]:
-    """Retrieve the links to all of the posts that contain the tags.
+def _get_post_urls(plan: QueryPlan, catalog: TagCatalog) -> List[str]:
+    """Retrieve the links to all of the posts that match a planned search.
 
     Args:
-        tags: The tags that the posts must contain.
+        plan: The planned search.
+        catalog: The tag statistics, updated with the size of every index fetched.
 
     Returns:
-        A list of post urls that contain all of the specified tags.
+        A list of post urls that contain all of the positive tags, excluding the posts that
+        contain all of the negative tags.
 
     """
-    if len(tags) == 0:
-        return tags
-    _LOGGER.debug('Retrieving all URLs that contain the tags %s', str(tags))
-    sanitized_tags = [sanitize_tag(tag) for tag in tags]
-    nozomi_urls  = [create_tag_filepath(sanitized_tag) for sanitized_tag in sanitized_tags]
-    tag_post_ids = [_get_post_ids(nozomi_url) for nozomi_url in nozomi_urls]
-    tag_post_ids = set.intersection(*map(set, tag_post_ids)) # Flatten list of tuples on intersection
-    post_urls = [create_post_filepath(post_id) for post_id in tag_post_ids]
-    _LOGGER.debug('Got %d post urls containing the tags %s', len(tags), str(tags))
+    if not plan.positive:
+        return []
+    _LOGGER.debug('Retrieving all URLs that match the plan %s', str(plan))
+    tag_post_ids = None
+    for step in plan.positive:
+        tag_post_ids = _fetch_tag_post_ids(step, tag_post_ids, catalog)
+        if not tag_post_ids:
+            return []
+    excluded_post_ids = set(tag_post_ids) if plan.negative else set()
+    for step in plan.negative:
+        excluded_post_ids = _fetch_tag_post_ids(step, excluded_post_ids, catalog)
+        if not excluded_post_ids:
+            break
+    post_urls = [create_post_filepath(post_id) for post_id in tag_post_ids - excluded_post_ids]
+    _LOGGER.debug('Got %d post urls matching the plan (estimated %s)',
+                  len(post_urls), str(plan.estimated_results))
     return post_urls
 
 
+def _stream_post_urls(plan: QueryPlan, catalog: TagCatalog, memory_budget: int) -> Iterator[str]:
+    """Generate the links to the posts that match a planned search while streaming the indexes.
+
+    The post IDs of the most selective positive tag are read in chunks, and every other tag is
+    checked with a cursor that reads its index in step, since all indexes share the same order.
+
+    Args:
+        plan: The planned search.
+        catalog: The tag statistics, updated with the size of every index fully read.
+        memory_budget: The number of raw bytes of tag indexes read at once, split evenly between
+            the indexes being streamed.
+
+    Raises:
+        InvalidIndexOrder: If a streamed index is not sorted from newest to oldest.
+
+    Yields:
+        The URL of a post that contains all of the positive tags, excluding the posts that contain
+        all of the negative tags.
+
+    """
+    if not plan.positive:
+        return
+    _LOGGER.debug('Streaming all URLs that match the plan %s', str(plan))
+    total_streams = len(plan.positive) + len(plan.negative)
+    chunk_size = max(4, memory_budget // total_streams // 4 * 4)  # multiple of the size of uint
+    first_step, *other_steps = plan.positive
+    post_ids = _iter_post_ids(first_step, catalog, chunk_size)
+    positive_cursors, negative_cursors = [], []
+    try:
+        for step in other_steps:
+            positive_cursors.append(_open_cursor(step, catalog, chunk_size))
+        for step in plan.negative:
+            negative_cursors.append(_open_cursor(step, catalog, chunk_size))
+        for post_id in post_ids:
+            if not all(cursor.contains(post_id) for cursor in positive_cursors):
+                if any(cursor.exhausted for cursor in positive_cursors):
+                    return
+                continue
+            if negative_cursors and all(cursor.contains(post_id) for cursor in negative_cursors):
+                continue
+            yield create_post_filepath(post_id)
+    finally:
+        # Release the streamed connections when the search ends, stops early or fails.
+        post_ids.close()
+        for cursor in positive_cursors + negative_cursors:
+            cursor.close()
+
+
+def _fetch_tag_post_ids(step: PlanStep, candidates: Optional[Set[int]],
+                        catalog: TagCatalog) -> Set[int]:
+    """Retrieve the post IDs of a tag, limited to the candidate posts.
+
+    Args:
+        step: The step of the plan for the tag.
+        candidates: The post IDs to restrict the result to, or None to retrieve every post ID.
+        catalog: The tag statistics, updated with the size of the tag's index.
+
+    Returns:
+        The candidate post IDs that contain the tag.
+
+    """
+    nozomi_url = create_tag_filepath(step.tag)
+    if step.strategy == PROBE and candidates is not None:
+        probed = _probe_post_ids(nozomi_url, candidates)
+        if probed is not None:
+            found_post_ids, total_ids = probed
+            catalog.record_index_size(step.tag, total_ids)
+            return found_post_ids
+        _LOGGER.info('Cannot probe %s, downloading the index', nozomi_url)
+    post_ids = _get_post_ids(nozomi_url)
+    catalog.record_index_size(step.tag, len(post_ids))
+    if candidates is None:
+        return set(post_ids)
+    return candidates.intersection(post_ids)
+
+
+def _probe_post_ids(tag_filepath_url: str, post_ids: Set[int]) -> Optional[Tuple[Set[int], int]]:
+    """Look up post IDs in a .nozomi file using ranged requests.
+
+    Args:
+        tag_filepath_url: The URL to a tag's .nozomi file.
+        post_ids: The post IDs to look up.
+
+    Returns:
+        The post IDs found in the file and the total number of post IDs in the file, or None if the
+        file cannot be probed.
+
+    """
+    _LOGGER.debug('Probing %s for %d post IDs', tag_filepath_url, len(post_ids))
+    probe = _IndexProbe(tag_filepath_url)
+    try:
+        if not probe.open():
+            return None
+        found_post_ids = set()
+        for post_id in post_ids:
+            found = probe.find(post_id)
+            if found is None:
+                return None
+            if found:
+                found_post_ids.add(post_id)
+        return found_post_ids, probe.total_ids
+    finally:
+        probe.close()
+
+
+def _get_index_entry(session: requests.Session, tag_filepath_url: str,
+                     position: int) -> Optional[Tuple[int, int]]:
+    """Retrieve a single post ID from a .nozomi file with a ranged request.
+
+    The response is streamed so that its body is never read if the server ignores the range and
+    sends the whole file instead.
+
+    Args:
+        session: The session the request is sent with.
+        tag_filepath_url: The URL to a tag's .nozomi file.
+        position: The position of the post ID in the file.
+
+    Returns:
+        The post ID and the total number of post IDs in the file, or None if the server did not
+        respond with the requested range.
+
+    """
+    start = position * 4  # size of uint
+    headers = {'Accept-Encoding': 'identity', 'Range': f'bytes={start}-{start + 3}'}
+    with session.get(tag_filepath_url, headers=headers, stream=True) as response:
+        if response.status_code != 206:
+            return None
+        total_bytes = response.headers.get('Content-Range', '').split('/')[-1]
+        if not total_bytes.isdigit():
+            return None
+        content = response.content
+    if len(content) != 4:
+        return None
+    total_ids = int(total_bytes) // 4
+    [post_id] = struct.unpack('!I', content)
+    return post_id, total_ids
+
+
 def _get_post_ids(tag_filepath_url: str) -> List[int]:
     """Retrieve the .nozomi data file.
 
@@ -175,3 +360,199 @@ def _get_post_ids(tag_filepath_url: str) -> List[int]:
     except Exception as ex:
         _LOGGER.exception(ex)
     return post_ids
+
+
+def _iter_post_ids(step: PlanStep, catalog: TagCatalog, chunk_size: int) -> Iterator[int]:
+    """Stream the .nozomi data file of a tag.
+
+    Args:
+        step: The step of the plan for the tag.
+        catalog: The tag statistics, updated with the size of the index once it is fully read.
+        chunk_size: The number of raw bytes read from the file at once.
+
+    Raises:
+        InvalidIndexOrder: If a post ID is not lower than the one before it.
+
+    Yields:
+        The post IDs that contain the tag, from newest to oldest.
+
+    """
+    tag_filepath_url = create_tag_filepath(step.tag)
+    _LOGGER.debug('Streaming post IDs from %s', tag_filepath_url)
+    headers = {'Accept-Encoding': 'gzip, deflate, br', 'Content-Type': 'arraybuffer'}
+    total_ids = 0
+    previous_post_id = None
+    with requests.get(tag_filepath_url, headers=headers, stream=True) as response:
+        remainder = b''
+        for chunk in response.iter_content(chunk_size=chunk_size):
+            data = remainder + chunk
+            unpacked_size = len(data) - len(data) % 4  # multiple of the size of uint
+            remainder = data[unpacked_size:]
+            # Unpack lazily so that only the raw bytes of the chunk are held in memory.
+            for (post_id,) in struct.iter_unpack('!I', memoryview(data)[:unpacked_size]):
+                if previous_post_id is not None and post_id >= previous_post_id:
+                    raise InvalidIndexOrder(
+                        f'The post IDs of {tag_filepath_url} are not sorted from newest to oldest.')
+                previous_post_id = post_id
+                total_ids += 1
+                yield post_id
+    catalog.record_index_size(step.tag, total_ids)
+
+
+def _open_cursor(step: PlanStep, catalog: TagCatalog,
+                 chunk_size: int) -> Union['_StreamCursor', '_ProbeCursor']:
+    """Open a cursor over the index of a tag.
+
+    Args:
+        step: The step of the plan for the tag.
+        catalog: The tag statistics, updated with the size of the tag's index.
+        chunk_size: The number of bytes read from the file at once when streaming.
+
+    Returns:
+        A cursor probing the index with ranged requests if planned and possible, otherwise a cursor
+        streaming the index.
+
+    """
+    if step.strategy == PROBE:
+        nozomi_url = create_tag_filepath(step.tag)
+        probe = _IndexProbe(nozomi_url)
+        if probe.open():
+            catalog.record_index_size(step.tag, probe.total_ids)
+            return _ProbeCursor(probe)
+        probe.close()
+        _LOGGER.info('Cannot probe %s, streaming the index', nozomi_url)
+    return _StreamCursor(_iter_post_ids(step, catalog, chunk_size))
+
+
+class _StreamCursor:
+    """Checks post IDs against a streamed index.
+
+    The post IDs looked up must not increase between calls, which allows the index to be read only
+    once and in chunks.
+
+    """
+
+    def __init__(self, post_ids: Iterator[int]):
+        """Create a cursor before the first post ID of the index."""
+        self._post_ids = post_ids
+        self._current = None
+        self._started = False
+
+    @property
+    def exhausted(self) -> bool:
+        """Whether the whole index has been read."""
+        return self._started and self._current is None
+
+    def contains(self, post_id: int) -> bool:
+        """Whether the index contains a post ID."""
+        if not self._started:
+            self._current = next(self._post_ids, None)
+            self._started = True
+        while self._current is not None and self._current > post_id:
+            self._current = next(self._post_ids, None)
+        return self._current == post_id
+
+    def close(self) -> None:
+        """Stop reading the index and release its connection."""
+        self._post_ids.close()
+
+
+class _ProbeCursor:
+    """Checks post IDs against an index with ranged requests."""
+
+    exhausted = False
+
+    def __init__(self, probe: '_IndexProbe'):
+        """Create a cursor over an opened probe of an index."""
+        self._probe = probe
+
+    def contains(self, post_id: int) -> bool:
+        """Whether the index contains a post ID."""
+        found = self._probe.find(post_id)
+        if found is None:
+            raise requests.HTTPError(f'Ranged request to {self._probe.tag_filepath_url} failed')
+        return found
+
+    def close(self) -> None:
+        """Release the connection of the probe."""
+        self._probe.close()
+
+
+class _IndexProbe:
+    """Looks up post IDs in a .nozomi file with ranged requests.
+
+    The requests share a session, so that the connection to the server is reused, and the post ID
+    at every position fetched is cached, since every binary search starts from the same positions.
+
+    The post IDs in a .nozomi file are sorted from newest to oldest (descending), so a post ID is
+    found with a binary search over the file.
+
+    """
+
+    def __init__(self, tag_filepath_url: str):
+        """Create a probe of a .nozomi file."""
+        self.tag_filepath_url = tag_filepath_url
+        self.total_ids: Optional[int] = None
+        self._session = requests.Session()
+        self._post_ids: Dict[int, int] = {}
+
+    def open(self) -> bool:
+        """Retrieve the number of post IDs in the file and check their order.
+
+        Returns:
+            Whether the file can be probed, which requires the server to support ranged requests
+            and the file to be sorted from newest to oldest.
+
+        """
+        first_entry = _get_index_entry(self._session, self.tag_filepath_url, 0)
+        if first_entry is None:
+            return False
+        first_post_id, total_ids = first_entry
+        self._post_ids[0] = first_post_id
+        if total_ids >= 2:
+            last_post_id = self._get_post_id(total_ids - 1)
+            if last_post_id is None:
+                return False
+            if first_post_id <= last_post_id:
+                _LOGGER.warning('The post IDs of %s are not sorted from newest to oldest',
+                                self.tag_filepath_url)
+                return False
+        self.total_ids = total_ids
+        return True
+
+    def find(self, post_id: int) -> Optional[bool]:
+        """Look up a single post ID in the file.
+
+        Args:
+            post_id: The post ID to look up.
+
+        Returns:
+            Whether the post ID is in the file, or None if a ranged request failed.
+
+        """
+        low, high = 0, self.total_ids - 1
+        while low <= high:
+            middle = (low + high) // 2
+            value = self._get_post_id(middle)
+            if value is None:
+                return None
+            if value == post_id:
+                return True
+            if value > post_id:
+                low = middle + 1
+            else:
+                high = middle - 1
+        return False
+
+    def close(self) -> None:
+        """Release the connection to the server."""
+        self._session.close()
+
+    def _get_post_id(self, position: int) -> Optional[int]:
+        """Retrieve the post ID at a position of the file, fetching it if it is not cached."""
+        if position not in self._post_ids:
+            entry = _get_index_entry(self._session, self.tag_filepath_url, position)
+            if entry is None:
+                return None
+            self._post_ids[position], _ = entry
+        return self._post_ids[position]
@@ -8,3 +8,6 @@ class InvalidTagFormat(NozomiException):
 
 class InvalidUrlFormat(NozomiException):
     """The url is not in valid format."""
+
+class InvalidIndexOrder(NozomiException):
+    """The post IDs of a .nozomi file are not sorted from newest to oldest."""
@@ -0,0 +1,243 @@
+"""Tag statistics catalog and query planner for tag searches.
+
+Every tag's .nozomi index is a flat array of post IDs, so downloading the index of a broad tag can
+cost several megabytes. The catalog remembers how large each tag's index is (from the ``count``
+field of tags seen in post metadata and from the indexes that have already been downloaded), which
+allows the planner to fetch the most selective tags first and to probe the remaining indexes for a
+handful of candidate posts instead of downloading them in full.
+
+Probing relies on the post IDs of every .nozomi file being sorted from newest to oldest
+(descending), which allows a post ID to be found with a binary search of ranged requests.
+
+"""
+
+import math
+import logging
+from dataclasses import dataclass, field
+from typing import Dict, ForwardRef, List, Optional
+
+from nozomi.exceptions import InvalidTagFormat
+from nozomi.helpers import sanitize_tag
+
+
+_LOGGER = logging.getLogger(__name__)
+
+# Prevent circular dependency issues
+Post = ForwardRef("Post")
+
+DOWNLOAD = 'download'
+PROBE = 'probe'
+
+# The number of bytes a single ranged request is considered to be worth. A probe is a round trip
+# for only 4 bytes of data, so its cost is the data that could have been downloaded during the round
+# trip instead (about 50ms at 5MB/s).
+PROBE_REQUEST_COST = 256 * 1024
+
+
+@dataclass(frozen=True)
+class TagStatistics:
+    """Statistics of a tag's .nozomi index.
+
+    Args:
+        tag (str): The sanitized tag.
+        count (int): The total number of posts that have the tag according to post metadata.
+        index_size (int): The number of post IDs in the tag's .nozomi file, if it has been fetched.
+
+    """
+
+    tag:        str
+    count:      Optional[int] = None
+    index_size: Optional[int] = None
+
+    @property
+    def estimated_size(self) -> Optional[int]:
+        """The best known estimate of the number of post IDs in the tag's index."""
+        return self.index_size if self.index_size is not None else self.count
+
+
+class TagCatalog:
+    """Local catalog of tag statistics used to plan tag searches."""
+
+    def __init__(self):
+        """Create an empty catalog."""
+        self._statistics: Dict[str, TagStatistics] = {}
+
+    def __len__(self) -> int:
+        """The number of tags in the catalog."""
+        return len(self._statistics)
+
+    def __contains__(self, tag: str) -> bool:
+        """Whether the catalog has statistics for a sanitized tag."""
+        return tag in self._statistics
+
+    def get(self, tag: str) -> TagStatistics:
+        """Retrieve the statistics of a tag.
+
+        Args:
+            tag: The sanitized tag.
+
+        Returns:
+            The statistics of the tag. The fields are empty if nothing is known about the tag.
+
+        """
+        return self._statistics.get(tag, TagStatistics(tag=tag))
+
+    def record_count(self, tag: str, count: int) -> None:
+        """Record the number of posts that have a tag according to post metadata.
+
+        Args:
+            tag: The sanitized tag.
+            count: The total number of posts that have the tag.
+
+        """
+        statistics = self.get(tag)
+        self._statistics[tag] = TagStatistics(tag=tag, count=count, index_size=statistics.index_size)
+
+    def record_index_size(self, tag: str, index_size: int) -> None:
+        """Record the number of post IDs in a tag's .nozomi file.
+
+        Args:
+            tag: The sanitized tag.
+            index_size: The number of post IDs in the tag's index.
+
+        """
+        statistics = self.get(tag)
+        self._statistics[tag] = TagStatistics(tag=tag, count=statistics.count, index_size=index_size)
+
+    def record_post(self, post: Post) -> None:
+        """Record the counts of every tag on a post.
+
+        Args:
+            post: The post whose tags will be recorded.
+
+        """
+        for tag in post.general + post.copyright + post.character + post.artist:
+            if tag.count is None:
+                continue
+            try:
+                self.record_count(sanitize_tag(tag.tag), tag.count)
+            except InvalidTagFormat:
+                _LOGGER.debug("Skipping statistics for invalid tag '%s'", tag.tag)
+
+
+@dataclass(frozen=True)
+class PlanStep:
+    """A single tag index fetch in a query plan.
+
+    Args:
+        tag (str): The sanitized tag.
+        strategy (str): Either ``DOWNLOAD`` to fetch the full index or ``PROBE`` to look up the
+            candidate posts in the index with ranged requests.
+        estimated_size (int): The estimated number of post IDs in the tag's index, if known.
+
+    """
+
+    tag:            str
+    strategy:       str
+    estimated_size: Optional[int]
+
+
+@dataclass(frozen=True)
+class QueryPlan:
+    """The order and strategy in which tag indexes are fetched for a search.
+
+    Args:
+        positive (List[PlanStep]): The steps for the tags the posts must contain.
+        negative (List[PlanStep]): The steps for the blacklisted tags.
+        estimated_results (int): Upper bound on the number of posts returned, if known.
+
+    """
+
+    positive:           List[PlanStep] = field(default_factory=list)
+    negative:           List[PlanStep] = field(default_factory=list)
+    estimated_results:  Optional[int] = None
+
+
+def plan_query(positive_tags: List[str], negative_tags: List[str] = None,
+               catalog: TagCatalog = None, request_cost: int = PROBE_REQUEST_COST) -> QueryPlan:
+    """Plan the order and strategy used to fetch the tag indexes of a search.
+
+    Tags with the smallest known index are fetched first, and tags without any statistics are
+    fetched last. The first positive tag is always downloaded since it provides the candidate
+    posts; every other tag is probed when looking up the candidates is cheaper than downloading
+    the full index.
+
+    Args:
+        positive_tags: The tags that the posts must contain.
+        negative_tags: Optional, blacklisted tags.
+        catalog: Optional, the tag statistics used to plan the search.
+        request_cost: Optional, the number of bytes a ranged request is considered to be worth.
+
+    Raises:
+        InvalidTagFormat: If one of the tags cannot be sanitized.
+
+    Returns:
+        The plan of the search.
+
+    """
+    if negative_tags is None:
+        negative_tags = list()
+    if catalog is None:
+        catalog = TagCatalog()
+    positive = _order_by_selectivity(positive_tags, catalog)
+    negative = _order_by_selectivity(negative_tags, catalog)
+    if not positive:
+        return QueryPlan(estimated_results=0)
+
+    positive_steps = [PlanStep(positive[0].tag, DOWNLOAD, positive[0].estimated_size)]
+    candidates = positive[0].estimated_size
+    for statistics in positive[1:]:
+        strategy = choose_strategy(statistics, candidates, request_cost)
+        positive_steps.append(PlanStep(statistics.tag, strategy, statistics.estimated_size))
+        if statistics.estimated_size is not None:
+            candidates = min(candidates, statistics.estimated_size)
+    # Candidates are only removed when they appear in every blacklisted index.
+    negative_steps = [
+        PlanStep(statistics.tag, choose_strategy(statistics, candidates, request_cost),
+                 statistics.estimated_size)
+        for statistics in negative
+    ]
+    plan = QueryPlan(positive=positive_steps, negative=negative_steps, estimated_results=candidates)
+    _LOGGER.debug('Planned query %s', plan)
+    return plan
+
+
+def choose_strategy(statistics: TagStatistics, candidates: Optional[int],
+                    request_cost: int = PROBE_REQUEST_COST) -> str:
+    """Decide whether a tag's index should be downloaded or probed for the candidate posts.
+
+    Probing a sorted index takes at most a binary search of ranged requests per candidate post,
+    plus two requests to learn the size of the index and check its order.
+
+    Args:
+        statistics: The statistics of the tag.
+        candidates: The estimated number of candidate posts, if known.
+        request_cost: Optional, the number of bytes a ranged request is considered to be worth.
+
+    Returns:
+        ``PROBE`` if probing is estimated to be cheaper than downloading, ``DOWNLOAD`` otherwise.
+
+    """
+    if candidates is None or statistics.estimated_size is None:
+        return DOWNLOAD
+    download_cost = statistics.estimated_size * 4  # size of uint
+    probe_requests = candidates * math.ceil(math.log2(statistics.estimated_size + 1)) + 2
+    if probe_requests * request_cost < download_cost:
+        return PROBE
+    return DOWNLOAD
+
+
+def _order_by_selectivity(tags: List[str], catalog: TagCatalog) -> List[TagStatistics]:
+    """Sanitize tags and order them from the smallest to the largest index.
+
+    Args:
+        tags: The unsanitized tags.
+        catalog: The tag statistics.
+
+    Returns:
+        The statistics of each tag, with tags of unknown size placed last.
+
+    """
+    sanitized_tags = dict.fromkeys(sanitize_tag(tag) for tag in tags)
+    statistics = [catalog.get(tag) for tag in sanitized_tags]
+    return sorted(statistics, key=lambda s: (s.estimated_size is None, s.estimated_size or 0))
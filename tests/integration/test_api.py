@@ -64,6 +64,17 @@ def test_retrieval_negative_tags(positive_tags, negative_tags):
         assert isinstance(post, Post)
 
 
+@pytest.mark.integration
+@pytest.mark.parametrize('positive_tags, negative_tags', [
+    (['akali', 'sakimichan'], ['nudity']),
+    (['veigar'], [])
+])
+def test_retrieval_streamed(positive_tags, negative_tags):
+    posts = api.get_posts_with_tags(positive_tags, negative_tags, stream=True, memory_budget=4096)
+    post_ids = [post.postid for post in posts]
+    assert post_ids == sorted(post_ids, reverse=True)
+
+
 @pytest.mark.integration
 @pytest.mark.parametrize('positive_tags, negative_tags', [
     (['akali', 'sakimichan'], [])
@@ -0,0 +1,114 @@
+"""Test the import-time footprint of the package.
+
+Run this module directly to print an import-time benchmark of the package modules.
+
+"""
+
+import subprocess
+import sys
+from pathlib import Path
+from typing import Dict
+
+import pytest
+
+
+HEAVY_MODULES = ['requests', 'dacite', 'nozomi.api', 'nozomi.data']
+BENCHMARK_MODULES = ['nozomi', 'nozomi.helpers', 'nozomi.planner', 'nozomi.api']
+REPOSITORY_ROOT = Path(__file__).resolve().parents[2]
+
+
+def run_python(statement: str, *options: str) -> subprocess.CompletedProcess:
+    """Run a statement in a fresh interpreter from the root of the repository.
+
+    Args:
+        statement: The Python statement to execute.
+        options: Additional interpreter options.
+
+    Returns:
+        The completed interpreter process.
+
+    """
+    return subprocess.run(
+        [sys.executable, *options, '-c', statement],
+        capture_output=True, text=True, check=True, cwd=REPOSITORY_ROOT
+    )
+
+
+def import_profile(statement: str) -> Dict[str, int]:
+    """Run an import statement in a fresh interpreter with import timing enabled.
+
+    Args:
+        statement: The Python statement to execute.
+
+    Returns:
+        The self import time in microseconds of every module imported, parsed from the
+        ``-X importtime`` report written to stderr.
+
+    """
+    report = run_python(statement, '-X', 'importtime').stderr
+    profile = {}
+    for line in report.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_time, _, module = line[len('import time:'):].split('|')
+        profile[module.strip()] = int(self_time)
+    return profile
+
+
+def import_time(module: str) -> int:
+    """Measure the time to import a module, excluding the modules loaded at interpreter startup.
+
+    Args:
+        module: The name of the module to import.
+
+    Returns:
+        The total self import time in microseconds of every module loaded by the import.
+
+    """
+    startup_modules = import_profile('pass')
+    profile = import_profile(f'import {module}')
+    return sum(time for name, time in profile.items() if name not in startup_modules)
+
+
+@pytest.mark.unit
+@pytest.mark.parametrize('statement', [
+    'import nozomi',
+    'import nozomi.helpers',
+    'from nozomi.helpers import create_tag_filepath, create_post_filepath'
+])
+def test_import_is_lightweight(statement: str):
+    modules = import_profile(statement)
+    for module in HEAVY_MODULES:
+        assert module not in modules
+
+
+@pytest.mark.unit
+def test_import_time_benchmark():
+    helpers_time = import_time('nozomi.helpers')
+    api_time = import_time('nozomi.api')
+    print(f'nozomi.helpers: {helpers_time} us, nozomi.api: {api_time} us')
+    assert helpers_time < api_time
+
+
+@pytest.mark.unit
+def test_lazy_submodule_access():
+    statement = '\n'.join([
+        'import sys, nozomi',
+        'assert "nozomi.api" not in sys.modules',
+        'assert "requests" not in sys.modules',
+        'assert nozomi.api.get_post',
+        'assert "nozomi.api" in sys.modules',
+        'assert nozomi.helpers.create_post_filepath(1) == "https://j.nozomi.la/post/1.json"',
+        'try:',
+        '    nozomi.missing',
+        'except AttributeError:',
+        '    pass',
+        'else:',
+        '    raise AssertionError("nozomi.missing did not raise AttributeError")',
+    ])
+    run_python(statement)
+
+
+if __name__ == '__main__':
+    for benchmark_module in BENCHMARK_MODULES:
+        print(f'{benchmark_module:<16} {import_time(benchmark_module):>8} us')
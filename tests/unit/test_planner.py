@@ -0,0 +1,102 @@
+"""Test the functionality of the query planner."""
+
+import pytest
+
+from dacite import from_dict
+
+from nozomi.data import Post
+from nozomi.exceptions import InvalidTagFormat
+from nozomi.planner import DOWNLOAD, PROBE, TagCatalog, TagStatistics, choose_strategy, plan_query
+
+
+def generate_catalog(**counts) -> TagCatalog:
+    """Generate a TagCatalog with the index sizes of some tags.
+
+    Args:
+        counts: The number of post IDs in the index of each tag.
+
+    Returns:
+        The catalog containing the index size of every tag.
+
+    """
+    catalog = TagCatalog()
+    for tag, count in counts.items():
+        catalog.record_index_size(tag, count)
+    return catalog
+
+
+@pytest.mark.unit
+def test_catalog_records_post_tags():
+    tag = {'tagurl': 'https://nozomi.la/tag/veigar-1.html', 'tag': 'Veigar', 'tagname_display': 'Veigar'}
+    post = from_dict(data_class=Post, data={
+        'is_video': '', 'type': 'jpg', 'dataid': '1', 'width': 0, 'height': 0, 'date': '', 'postid': 1,
+        'character': [dict(tag, count=120)], 'general': [dict(tag, tag='wallpaper', count=None)]
+    })
+    catalog = TagCatalog()
+    catalog.record_post(post)
+    assert len(catalog) == 1
+    assert catalog.get('veigar') == TagStatistics(tag='veigar', count=120)
+    assert 'wallpaper' not in catalog
+
+
+@pytest.mark.unit
+def test_catalog_prefers_index_size():
+    catalog = TagCatalog()
+    catalog.record_index_size('veigar', 100)
+    catalog.record_count('veigar', 120)
+    assert catalog.get('veigar').estimated_size == 100
+    assert catalog.get('unknown').estimated_size is None
+
+
+@pytest.mark.unit
+def test_plan_orders_by_selectivity():
+    catalog = generate_catalog(wallpaper=50000, veigar=300)
+    plan = plan_query(['wallpaper', 'unknown', 'Veigar'], catalog=catalog)
+    assert [step.tag for step in plan.positive] == ['veigar', 'wallpaper', 'unknown']
+    assert plan.estimated_results == 300
+
+
+@pytest.mark.unit
+@pytest.mark.parametrize('counts, expected', [
+    ({'narrow': 3, 'broad': 10000000}, PROBE),
+    ({'narrow': 3000, 'broad': 5000}, DOWNLOAD),
+    ({'narrow': 3}, DOWNLOAD)
+])
+def test_plan_strategy(counts, expected):
+    plan = plan_query(['narrow', 'broad'], ['broad'], catalog=generate_catalog(**counts))
+    assert plan.positive[0].strategy == DOWNLOAD
+    assert plan.positive[1].strategy == expected
+    assert plan.negative[0].strategy == expected
+
+
+@pytest.mark.unit
+def test_plan_without_positive_tags():
+    plan = plan_query([], ['nudity'])
+    assert plan.positive == []
+    assert plan.estimated_results == 0
+
+
+@pytest.mark.unit
+def test_plan_invalid_tag():
+    with pytest.raises(InvalidTagFormat):
+        plan_query(['veigar', '-'])
+
+
+@pytest.mark.unit
+@pytest.mark.parametrize('size, candidates, expected', [
+    (None, 10, DOWNLOAD),
+    (1000000, None, DOWNLOAD),
+    (10000000, 2, PROBE),
+    (1000000, 10, DOWNLOAD),
+    (1000000, 1000, DOWNLOAD)
+])
+def test_choose_strategy(size, candidates, expected):
+    assert choose_strategy(TagStatistics(tag='tag', index_size=size), candidates) == expected
+
+
+@pytest.mark.unit
+def test_request_cost_is_overridable():
+    catalog = generate_catalog(narrow=10, broad=1000000)
+    assert plan_query(['narrow', 'broad'], catalog=catalog).positive[1].strategy == DOWNLOAD
+    plan = plan_query(['narrow', 'broad'], catalog=catalog, request_cost=1024)
+    assert plan.positive[1].strategy == PROBE
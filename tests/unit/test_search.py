@@ -0,0 +1,355 @@
+"""Test the tag search functions of the api against a mocked server."""
+
+import random
+import struct
+from typing import Dict, List
+
+import pytest
+import requests
+
+from nozomi import api
+from nozomi.exceptions import InvalidIndexOrder
+from nozomi.helpers import create_post_filepath
+from nozomi.planner import DOWNLOAD, PROBE, PlanStep, QueryPlan, TagCatalog
+
+
+class MockResponse:
+    """Response of the mocked server, which records the bytes of its body read by the client."""
+
+    def __init__(self, server: 'MockServer', request: tuple, body: bytes, status_code: int = 200,
+                 headers: Dict[str, str] = None):
+        self.server = server
+        self.request = request
+        self.body = body
+        self.status_code = status_code
+        self.headers = headers or {}
+        self.consumed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.server.closed.append(self.request)
+
+    @property
+    def content(self) -> bytes:
+        """Read the whole body, which is kept once read."""
+        if not self.consumed:
+            self.server.transferred.append((*self.request, len(self.body)))
+            self.consumed = True
+        return self.body
+
+    def iter_content(self, chunk_size: int):
+        """Split the body in chunks, ignoring the chunk size if the server splits them."""
+        split = self.server.split or chunk_size
+        for start in range(0, len(self.body), split):
+            chunk = self.body[start:start + split]
+            self.server.streamed.append((*self.request, len(chunk)))
+            yield chunk
+
+
+class MockServer:
+    """Serves the .nozomi files of tags, with or without support for ranged requests.
+
+    Args:
+        indexes: The post IDs of the .nozomi file of each tag.
+        ranged: Whether the server responds to ranged requests with partial content.
+        split: Optional, the size of the chunks the streamed files are split in.
+
+    """
+
+    def __init__(self, indexes: Dict[str, List[int]], ranged: bool = True, split: int = None):
+        self.indexes = indexes
+        self.ranged = ranged
+        self.split = split
+        self.requests = []
+        self.transferred = []  # Bodies read in full
+        self.streamed = []  # Chunks of bodies read while streaming
+        self.closed = []
+        self.sessions = []
+
+    def get(self, url: str, headers: Dict[str, str] = None, stream: bool = False,
+            **kwargs) -> MockResponse:
+        response = self.respond(url, headers or {})
+        if not stream:
+            response.content  # Like requests, the body is downloaded unless it is streamed
+        return response
+
+    def respond(self, url: str, headers: Dict[str, str]) -> MockResponse:
+        tag = url.split('/')[-1][:-len('.nozomi')]
+        post_ids = self.indexes[tag]
+        content = struct.pack(f'!{len(post_ids)}I', *post_ids)
+        byte_range = headers.get('Range')
+        request = (tag, byte_range)
+        self.requests.append(request)
+        if byte_range is None or not self.ranged:
+            return MockResponse(self, request, content)
+        start, end = map(int, byte_range[len('bytes='):].split('-'))
+        if start >= len(content):
+            return MockResponse(self, request, b'', 416)
+        content_range = f'bytes {start}-{end}/{len(content)}'
+        return MockResponse(self, request, content[start:end + 1], 206, {'Content-Range': content_range})
+
+    def session(self) -> 'MockSession':
+        """Open a session with the server."""
+        session = MockSession(self)
+        self.sessions.append(session)
+        return session
+
+    def bytes_read(self, tag: str) -> int:
+        """The number of bytes of the file of a tag read by the client."""
+        return sum(size for requested_tag, _, size in self.transferred + self.streamed
+                   if requested_tag == tag)
+
+    def ranged_requests(self, tag: str) -> int:
+        """The number of ranged requests made for the file of a tag."""
+        return sum(1 for requested_tag, byte_range in self.requests
+                   if requested_tag == tag and byte_range is not None)
+
+
+class MockSession:
+    """Session with the mocked server, which records the requests sent with it."""
+
+    def __init__(self, server: MockServer):
+        self.server = server
+        self.requests = []
+        self.is_closed = False
+
+    def get(self, url: str, **kwargs) -> MockResponse:
+        assert not self.is_closed
+        self.requests.append(url)
+        return self.server.get(url, **kwargs)
+
+    def close(self):
+        self.is_closed = True
+
+
+@pytest.fixture
+def mock_server(monkeypatch):
+    """Replace the requests made by the api with a mocked server of .nozomi files."""
+    def create(indexes: Dict[str, List[int]], **kwargs) -> MockServer:
+        server = MockServer(indexes, **kwargs)
+        monkeypatch.setattr(api.requests, 'get', server.get)
+        monkeypatch.setattr(api.requests, 'Session', server.session)
+        return server
+    return create
+
+
+@pytest.mark.unit
+def test_probe_finds_and_misses_post_ids(mock_server):
+    server = mock_server({'tag': list(range(1000, 0, -3))})
+    found_post_ids, total_ids = api._probe_post_ids('https://j.nozomi.la/nozomi/tag.nozomi', {1000, 997, 4, 999, 2})
+    assert found_post_ids == {1000, 997, 4}
+    assert total_ids == 334
+    assert server.ranged_requests('tag') < 334
+
+
+@pytest.mark.unit
+def test_probe_shares_a_session_and_caches_post_ids(mock_server):
+    server = mock_server({'tag': list(range(100000, 0, -1))})
+    found_post_ids, _ = api._probe_post_ids('https://j.nozomi.la/nozomi/tag.nozomi', {99999, 99998, 7})
+    assert found_post_ids == {99999, 99998, 7}
+    [session] = server.sessions
+    assert session.is_closed
+    assert len(session.requests) == server.ranged_requests('tag')
+    assert len(server.requests) == len(set(server.requests))  # No position is requested twice
+
+
+@pytest.mark.unit
+@pytest.mark.parametrize('ranged, indexes', [
+    (True, {'tag': [5, 7, 9]}),  # Not sorted from newest to oldest
+    (False, {'tag': [9, 7, 5]}),
+])
+def test_probe_unavailable(mock_server, ranged, indexes):
+    mock_server(indexes, ranged=ranged)
+    assert api._probe_post_ids('https://j.nozomi.la/nozomi/tag.nozomi', {7}) is None
+
+
+@pytest.mark.unit
+def test_fetch_probed_tag(mock_server):
+    server = mock_server({'tag': list(range(100000, 0, -2))})
+    catalog = TagCatalog()
+    post_ids = api._fetch_tag_post_ids(PlanStep('tag', PROBE, None), {10, 11}, catalog)
+    assert post_ids == {10}
+    assert catalog.get('tag').index_size == 50000
+    assert server.requests.count(('tag', None)) == 0
+
+
+@pytest.mark.unit
+@pytest.mark.parametrize('ranged, indexes, expected, index_size', [
+    (True, {'tag': []}, set(), 0),
+    (False, {'tag': [9, 7, 5]}, {7}, 3),
+    (True, {'tag': [5, 7, 9]}, {7}, 3)
+])
+def test_fetch_probed_tag_falls_back_to_download(mock_server, ranged, indexes, expected, index_size):
+    server = mock_server(indexes, ranged=ranged)
+    catalog = TagCatalog()
+    post_ids = api._fetch_tag_post_ids(PlanStep('tag', PROBE, None), {7, 8}, catalog)
+    assert post_ids == expected
+    assert catalog.get('tag').index_size == index_size
+    assert server.requests.count(('tag', None)) == 1
+    assert server.bytes_read('tag') <= len(indexes['tag']) * 4 + 8  # Index and probed entries
+
+
+@pytest.mark.unit
+def test_fetch_probed_tag_transfers_index_once(mock_server):
+    server = mock_server({'tag': list(range(100000, 0, -1))}, ranged=False)
+    post_ids = api._fetch_tag_post_ids(PlanStep('tag', PROBE, None), {7, 100001}, TagCatalog())
+    assert post_ids == {7}
+    assert server.transferred == [('tag', None, 400000)]
+
+
+@pytest.mark.unit
+def test_fetch_downloaded_tag(mock_server):
+    mock_server({'tag': [9, 7, 5]})
+    catalog = TagCatalog()
+    assert api._fetch_tag_post_ids(PlanStep('tag', DOWNLOAD, None), None, catalog) == {9, 7, 5}
+    assert catalog.get('tag').index_size == 3
+
+
+def generate_plan(positive: List[str], negative: List[str] = None, probed: List[str] = None) -> QueryPlan:
+    """Generate a QueryPlan for the tags in the given order.
+
+    Args:
+        positive: The tags that the posts must contain.
+        negative: Optional, blacklisted tags.
+        probed: Optional, the tags to probe instead of downloading.
+
+    Returns:
+        The plan of the search.
+
+    """
+    probed = probed or []
+    step = lambda tag: PlanStep(tag, PROBE if tag in probed else DOWNLOAD, None)
+    return QueryPlan(positive=[step(tag) for tag in positive],
+                     negative=[step(tag) for tag in negative or []])
+
+
+def post_urls(post_ids: List[int]) -> List[str]:
+    """Build the URLs of posts."""
+    return [create_post_filepath(post_id) for post_id in post_ids]
+
+
+@pytest.mark.unit
+@pytest.mark.parametrize('chunk_size, split', [(4, None), (8, 7), (4, 5), (1024, 3)])
+def test_iter_post_ids_chunk_boundaries(mock_server, chunk_size, split):
+    post_ids = list(range(500, 0, -7))
+    mock_server({'tag': post_ids}, split=split)
+    catalog = TagCatalog()
+    assert list(api._iter_post_ids(PlanStep('tag', DOWNLOAD, None), catalog, chunk_size)) == post_ids
+    assert catalog.get('tag').index_size == len(post_ids)
+
+
+@pytest.mark.unit
+@pytest.mark.parametrize('post_ids', [[5, 7, 9], [9, 7, 7, 5]])
+def test_iter_post_ids_out_of_order(mock_server, post_ids):
+    mock_server({'tag': post_ids})
+    with pytest.raises(InvalidIndexOrder):
+        list(api._iter_post_ids(PlanStep('tag', DOWNLOAD, None), TagCatalog(), 4))
+
+
+@pytest.mark.unit
+def test_stream_cursor():
+    cursor = api._StreamCursor(iter([9, 7, 5]))
+    assert not cursor.exhausted
+    assert not cursor.contains(10)
+    assert cursor.contains(9)
+    assert cursor.contains(7)
+    assert not cursor.contains(6)
+    assert not cursor.exhausted
+    assert cursor.contains(5)
+    assert not cursor.contains(1)
+    assert cursor.exhausted
+
+
+@pytest.mark.unit
+def test_probe_cursor_without_ranged_requests(mock_server):
+    server = mock_server({'tag': [9, 7, 5]}, ranged=False)
+    probe = api._IndexProbe('https://j.nozomi.la/nozomi/tag.nozomi')
+    probe.total_ids = 3
+    cursor = api._ProbeCursor(probe)
+    with pytest.raises(requests.HTTPError):
+        cursor.contains(7)
+    cursor.close()
+    assert all(session.is_closed for session in server.sessions)
+
+
+@pytest.mark.unit
+def test_stream_stops_when_positive_index_is_exhausted(mock_server):
+    mock_server({'broad': list(range(1000, 0, -1)), 'narrow': [990, 980]}, split=4)
+    catalog = TagCatalog()
+    urls = list(api._stream_post_urls(generate_plan(['broad', 'narrow']), catalog, 64))
+    assert urls == post_urls([990, 980])
+    assert catalog.get('narrow').index_size == 2
+    assert catalog.get('broad').index_size is None  # Not read until the end
+
+
+@pytest.mark.unit
+def test_stream_closes_indexes_when_stopped(mock_server):
+    server = mock_server({'a': list(range(1000, 0, -1)), 'b': list(range(1000, 0, -2)), 'c': [5]},
+                         split=4)
+    urls = api._stream_post_urls(generate_plan(['a', 'b'], ['c']), TagCatalog(), 64)
+    assert next(urls) == create_post_filepath(1000)
+    urls.close()
+    assert sorted(server.closed) == sorted(server.requests)
+
+
+@pytest.mark.unit
+def test_stream_does_not_read_unused_indexes(mock_server):
+    server = mock_server({'empty': [], 'a': [3, 2, 1], 'b': [2]})
+    assert list(api._stream_post_urls(generate_plan(['empty', 'a'], ['b']), TagCatalog(), 64)) == []
+    assert server.requests == [('empty', None)]
+
+
+@pytest.mark.unit
+def test_stream_probe_without_ranged_requests(mock_server):
+    server = mock_server({'narrow': [90000, 7], 'broad': list(range(100000, 0, -1))},
+                         ranged=False, split=64)
+    catalog = TagCatalog()
+    plan = generate_plan(['narrow', 'broad'], probed=['broad'])
+    assert isinstance(api._open_cursor(plan.positive[1], catalog, 64), api._StreamCursor)
+    assert list(api._stream_post_urls(plan, catalog, 64)) == post_urls([90000, 7])
+    assert server.transferred == []  # Every index is streamed, never read in full
+    assert max(size for _, _, size in server.streamed) <= 64
+    assert server.bytes_read('broad') == 400000  # Streamed once, ranged requests are not read
+
+
+@pytest.mark.unit
+def test_stream_excludes_posts_in_every_negative_index(mock_server):
+    mock_server({'tag': list(range(10, 0, -1)), 'n1': [9, 8, 7], 'n2': [8, 7, 6]})
+    urls = list(api._stream_post_urls(generate_plan(['tag'], ['n1', 'n2']), TagCatalog(), 64))
+    assert urls == post_urls([10, 9, 6, 5, 4, 3, 2, 1])
+
+
+@pytest.mark.unit
+@pytest.mark.parametrize('indexes', [
+    {'first': [3, 2, 1], 'second': [2, 3, 1]},
+    {'first': [1, 2, 3], 'second': [3, 2, 1]}
+])
+def test_stream_out_of_order(mock_server, indexes):
+    mock_server(indexes)
+    with pytest.raises(InvalidIndexOrder):
+        list(api._stream_post_urls(generate_plan(['first', 'second']), TagCatalog(), 64))
+
+
+@pytest.mark.unit
+@pytest.mark.parametrize('positive, negative, probed', [
+    (['a', 'b'], ['c', 'd'], []),
+    (['a', 'b', 'c'], ['d'], []),
+    (['small', 'a'], ['b', 'c'], ['a', 'b']),
+    (['small', 'a', 'b'], [], ['b']),
+    (['small'], ['empty'], []),
+    (['empty', 'a'], [], [])
+])
+@pytest.mark.parametrize('memory_budget', [4, 100, 1024 * 1024])
+def test_stream_matches_download(mock_server, positive, negative, probed, memory_budget):
+    generator = random.Random(42)
+    indexes = {tag: sorted(generator.sample(range(1, 5000), size), reverse=True)
+               for tag, size in [('a', 2500), ('b', 3000), ('c', 1000), ('d', 4000), ('small', 20)]}
+    indexes['empty'] = []
+    mock_server(indexes, split=7)
+    plan = generate_plan(positive, negative, probed)
+    streamed = list(api._stream_post_urls(plan, TagCatalog(), memory_budget))
+    downloaded = api._get_post_urls(plan, TagCatalog())
+    assert len(streamed) == len(set(streamed))
+    assert set(streamed) == set(downloaded)